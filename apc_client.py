@@ -0,0 +1,103 @@
+"""
+Minimal client for the apcupsd Network Information Server (NIS).
+Speaks the same protocol as apcaccess over a socket that is kept open
+between queries, so polling does not fork a process per reading.
+"""
+
+import re
+import socket
+import struct
+import threading
+
+# Unit suffix apcupsd appends to numeric values (e.g. b"121.0 Volts")
+_UNIT_RE = re.compile(rb'\s+(?:Percent|Volts|Minutes|Seconds|Hz|C)$')
+
+
+def parse_status(lines):
+    """Parse apcupsd "KEY : value" lines (bytes) into a dict without unit suffixes."""
+    status = {}
+    for line in lines:
+        key, sep, value = line.partition(b':')
+        if sep:
+            status[key.strip().decode(errors='replace')] = _UNIT_RE.sub(b'', value.strip()).decode(errors='replace')
+    return status
+
+
+class ApcClient:
+    """Persistent connection to an apcupsd NIS server."""
+
+    def __init__(self, host, port=3551, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        # Request threads share one client; the NIS protocol is strictly
+        # request/response, so queries must not interleave on the socket
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the socket if it is not already connected."""
+        if self._sock is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            # Let the kernel notice a dead peer on an idle connection
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+            self._sock = sock
+        return self._sock
+
+    def close(self):
+        """Close the socket; the next fetch reconnects."""
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _recv_exact(self, size):
+        """Read exactly size bytes from the socket."""
+        buf = b''
+        while len(buf) < size:
+            chunk = self._sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("apcupsd closed the connection")
+            buf += chunk
+        return buf
+
+    def _query(self):
+        """Send the status command and read the framed report."""
+        sock = self._connect()
+        sock.sendall(struct.pack('>H', 6) + b'status')
+
+        # Each record is a 2-byte big-endian length followed by a
+        # "KEY      : value" line; a zero length ends the report
+        lines = []
+        while True:
+            (length,) = struct.unpack('>H', self._recv_exact(2))
+            if length == 0:
+                break
+            lines.append(self._recv_exact(length))
+        return parse_status(lines)
+
+    def fetch(self):
+        """Query the status report and return it parsed by parse_status()."""
+        with self._lock:
+            reused = self._sock is not None
+            try:
+                return self._query()
+            except ConnectionError:
+                # apcupsd may have dropped the idle connection; retry once
+                # on a fresh socket, but not if that socket was just opened
+                self.close()
+                if not reused:
+                    raise
+            except OSError:
+                self.close()
+                raise
+
+            try:
+                return self._query()
+            except OSError:
+                self.close()
+                raise
@@ -1,11 +1,18 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 import os
 import argparse
 import subprocess
 import json
+import threading
+import time
+import orjson
 from dotenv import load_dotenv
 from datetime import datetime
+from types import MappingProxyType
 import database
+from apc_client import ApcClient, parse_status
 
 # Load environment variables
 load_dotenv()
@@ -19,238 +26,212 @@ UPS_WATTS = int(os.getenv('UPS_WATTS', 2700))
 POWER_FACTOR = float(os.getenv('POWER_FACTOR', 0.9))  # Actual power factor (2700W/3000VA)
 NOMINAL_VOLTAGE = int(os.getenv('NOMINAL_VOLTAGE', 120))  # Nominal voltage for warnings
 ELECTRICITY_RATE = float(os.getenv('ELECTRICITY_RATE', 0.124))  # Cost per kWh in dollars
+APCUPSD_HOST = os.getenv('APCUPSD_HOST', '10.0.0.13')
+APCUPSD_PORT = int(os.getenv('APCUPSD_PORT', 3551))
+STATUS_CACHE_TTL = float(os.getenv('STATUS_CACHE_TTL', 2))  # Seconds to reuse a UPS status fetch
+SIMULATE_POWER_EVENT = os.getenv('SIMULATE_POWER_EVENT', '').lower() == 'true'
+
+# Cost of drawing one watt for an hour, day, week (24 * 7 hours) and
+# average month (24 * 365.242 / 12 hours)
+_COST_PER_WATT_HOUR = ELECTRICITY_RATE / 1000
+_COST_PER_WATT_DAY = _COST_PER_WATT_HOUR * 24
+_COST_PER_WATT_WEEK = _COST_PER_WATT_HOUR * 168
+_COST_PER_WATT_MONTH = _COST_PER_WATT_HOUR * 730.484
+
+# Configuration values reported alongside every status
+_CONFIG_FIELDS = {
+    'UPS_VA': UPS_VA,
+    'UPS_WATTS': UPS_WATTS,
+    'POWER_FACTOR': POWER_FACTOR,
+    'NOMINAL_VOLTAGE': NOMINAL_VOLTAGE,
+    'ELECTRICITY_RATE': ELECTRICITY_RATE,
+}
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by the orjson C extension."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Compress the dashboard page and history; history JSON shrinks several-fold.
+# Only routes decorated with @compress.compressed() are compressed: Flask-Compress
+# appends ':gzip' to the ETag of compressed responses, which would stop the
+# small /api/status payload from ever revalidating to a 304
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'application/json']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_REGISTER'] = False
+compress = Compress(app)
+
+# Readings reported while simulating a power event (UPS running on battery)
+_SIM_BASE = MappingProxyType({
+    'STATUS': 'ONBATT',
+    'LOADPCT': '25.0',
+    'BCHARGE': '85.0',
+    'TIMELEFT': '45.0',
+    'LINEV': '0.0',  # No input voltage
+    'OUTPUTV': '121.6',
+    'LINEFREQ': '0.0',
+    'ITEMP': '22.5',
+    'BATTV': '54.2',
+    'NUMXFERS': '1',
+    'TONBATT': '300',  # 5 minutes on battery
+    'CUMONBATT': '1800',  # 30 minutes total
+    'LASTXFER': 'Low line voltage',
+    'MODEL': 'Smart-UPS 3000 XL',
+    'SERIALNO': 'JS0745010850',
+    'FIRMWARE': '691.17.D'
+})
+
+# Most recent (UPS status, ETag) snapshot, shared by all request threads
+_status_cache = {'ts': 0.0, 'val': (None, None)}
+_status_lock = threading.Lock()
+
+# Power statistics per window length as (monotonic time, stats); a week of
+# readings barely moves within a minute, so each window is aggregated at most
+# once per STATS_CACHE_TTL however many dashboards are polling
+STATS_CACHE_TTL = 60
+_stats_cache = {}
+
+# Current second and its formatted timestamps, see _now_str()/_now_iso()
+_now_cache = (0, '', '')
+
+# Long-lived connection to the apcupsd network information server
+ups_client = ApcClient(APCUPSD_HOST, APCUPSD_PORT)
+
+def _now_strings():
+    """Return the cached (display, ISO) timestamps, reformatting at most once per second."""
+    global _now_cache
+    now = int(time.time())
+    cached = _now_cache
+    if cached[0] != now:
+        moment = datetime.fromtimestamp(now)
+        cached = _now_cache = (now, moment.strftime('%Y-%m-%d %H:%M:%S'), moment.isoformat())
+    return cached
+
+def _now_str():
+    """Current local time as 'YYYY-MM-DD HH:MM:SS'."""
+    return _now_strings()[1]
+
+def _now_iso():
+    """Current local time in ISO 8601 format, to the second."""
+    return _now_strings()[2]
 
-def calculate_watts(load_percent):
-    """Calculate watts from load percentage."""
+def format_duration(seconds):
+    """Format duration in seconds to HH:MM:SS."""
     try:
-        load_pct = float(load_percent)
-        return round(UPS_WATTS * load_pct / 100, 1)
+        seconds = int(seconds)
     except (ValueError, TypeError):
-        return 0.0
-
-def calculate_amps(watts, voltage=120):
-    """Calculate amps from watts and voltage."""
+        return "Unknown"
+    if seconds == 0:
+        return "None"
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+def _enrich(status, voltage_key='LINEV',
+            _ups_watts=UPS_WATTS, _nominal_voltage=NOMINAL_VOLTAGE,
+            _hour=_COST_PER_WATT_HOUR, _day=_COST_PER_WATT_DAY,
+            _week=_COST_PER_WATT_WEEK, _month=_COST_PER_WATT_MONTH):
+    """Add power, cost, configuration and timestamp fields to a UPS status dict."""
+    # Configuration is bound as defaults so the hot path uses local lookups
+    # Calculate power metrics, reported as JSON numbers
     try:
-        return round(watts / voltage, 2)
-    except (ValueError, TypeError, ZeroDivisionError):
-        return 0.0
-
-def calculate_power_cost(watts):
-    """Calculate hourly power cost."""
+        load_pct = float(status.get('LOADPCT', '0'))
+    except (TypeError, ValueError):
+        load_pct = 0.0
     try:
-        return round((watts / 1000) * ELECTRICITY_RATE, 3)
-    except (ValueError, TypeError):
-        return 0.0
+        voltage = float(status.get(voltage_key, _nominal_voltage))
+    except (TypeError, ValueError):
+        voltage = float(_nominal_voltage)
+    watts = round(_ups_watts * load_pct / 100, 1)
+    amps = round(watts / voltage, 2) if voltage else 0.0
+    status['WATTS'] = watts
+    status['AMPS'] = amps
+    status['VOLTAGE'] = voltage
+    status['COST_HOUR'] = round(watts * _hour, 3)
+    status['COST_DAILY'] = round(watts * _day, 2)
+    status['COST_WEEKLY'] = round(watts * _week, 2)
+    status['COST_MONTHLY'] = round(watts * _month, 2)
 
-def calculate_daily_cost(watts):
-    """Calculate daily power cost."""
-    try:
-        # 24 hours in a day
-        return round((watts / 1000) * ELECTRICITY_RATE * 24, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    # Add configuration values
+    status.update(_CONFIG_FIELDS)
 
-def calculate_weekly_cost(watts):
-    """Calculate weekly power cost."""
-    try:
-        # 168 hours in a week (24 * 7)
-        return round((watts / 1000) * ELECTRICITY_RATE * 168, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    # Format any time durations
+    if 'TONBATT' in status:
+        status['TONBATT_FORMATTED'] = format_duration(status['TONBATT'])
+    if 'CUMONBATT' in status:
+        status['CUMONBATT_FORMATTED'] = format_duration(status['CUMONBATT'])
 
-def calculate_monthly_cost(watts):
-    """Calculate monthly power cost."""
-    try:
-        # ~730.484 hours in an average month (24 * 365.242 / 12)
-        return round((watts / 1000) * ELECTRICITY_RATE * 730.484, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    # Add timestamp
+    status['TIMESTAMP'] = _now_str()
 
-def format_duration(seconds):
-    """Format duration in seconds to HH:MM:SS."""
-    try:
-        seconds = int(seconds)
-        if seconds == 0:
-            return "None"
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        secs = seconds % 60
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
-    except (ValueError, TypeError):
-        return "Unknown"
+    return status
 
 def simulate_power_event():
     """Simulate a power event for testing purposes."""
-    from datetime import datetime, timedelta
-    
-    # Simulate UPS running on battery
-    status = {
-        'STATUS': 'ONBATT',
-        'LOADPCT': '25.0',
-        'BCHARGE': '85.0',
-        'TIMELEFT': '45.0',
-        'LINEV': '0.0',  # No input voltage
-        'OUTPUTV': '121.6',
-        'LINEFREQ': '0.0',
-        'ITEMP': '22.5',
-        'BATTV': '54.2',
-        'NUMXFERS': '1',
-        'TONBATT': '300',  # 5 minutes on battery
-        'CUMONBATT': '1800',  # 30 minutes total
-        'LASTXFER': 'Low line voltage',
-        'MODEL': 'Smart-UPS 3000 XL',
-        'SERIALNO': 'JS0745010850',
-        'FIRMWARE': '691.17.D',
-        'TIMESTAMP': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    
-    # Calculate power metrics
+    # No input voltage while on battery, so use output voltage for amps calc
+    return _enrich(dict(_SIM_BASE), voltage_key='OUTPUTV')
+
+def _status_snapshot():
+    """Return (status, etag), reusing a recent fetch if it is younger than STATUS_CACHE_TTL."""
+    if time.monotonic() - _status_cache['ts'] < STATUS_CACHE_TTL:
+        return _status_cache['val']
+
+    # Only one thread queries the UPS at a time. While a refresh is in flight
+    # other requests keep serving the previous snapshot instead of blocking on
+    # UPS I/O; they only wait when there is nothing cached yet.
+    if not _status_lock.acquire(blocking=_status_cache['val'][0] is None):
+        return _status_cache['val']
     try:
-        load_pct = float(status.get('LOADPCT', '0'))
-        watts = calculate_watts(load_pct)
-        voltage = float(status.get('OUTPUTV', NOMINAL_VOLTAGE))  # Use output voltage for amps calc
-        amps = calculate_amps(watts, voltage)
-        status['WATTS'] = f"{watts}"
-        status['AMPS'] = f"{amps}"
-        status['VOLTAGE'] = f"{voltage}"
-        status['COST_HOUR'] = f"{calculate_power_cost(watts)}"
-        status['COST_DAILY'] = f"{calculate_daily_cost(watts)}"
-        status['COST_WEEKLY'] = f"{calculate_weekly_cost(watts)}"
-        status['COST_MONTHLY'] = f"{calculate_monthly_cost(watts)}"
-    except ValueError:
-        app.logger.warning("Could not calculate power metrics")
-
-    # Add configuration values
-    status['UPS_VA'] = UPS_VA
-    status['UPS_WATTS'] = UPS_WATTS
-    status['POWER_FACTOR'] = POWER_FACTOR
-    status['NOMINAL_VOLTAGE'] = NOMINAL_VOLTAGE
-    status['ELECTRICITY_RATE'] = ELECTRICITY_RATE
-
-    # Format time durations
-    status['TONBATT_FORMATTED'] = format_duration(status['TONBATT'])
-    status['CUMONBATT_FORMATTED'] = format_duration(status['CUMONBATT'])
-    
-    return status
+        if time.monotonic() - _status_cache['ts'] < STATUS_CACHE_TTL:
+            return _status_cache['val']
+        status = fetch_ups_status()
+        # The fetch time identifies the snapshot for conditional requests
+        snapshot = (status, f"{time.time():.3f}" if status is not None else None)
+        _status_cache['val'] = snapshot
+        _status_cache['ts'] = time.monotonic()
+        return snapshot
+    finally:
+        _status_lock.release()
 
 def get_ups_status():
+    """Get UPS status, reusing a recent fetch if it is younger than STATUS_CACHE_TTL."""
+    return _status_snapshot()[0]
+
+def fetch_ups_status():
     """Get UPS status from APCUPSD with enhanced metrics."""
     # Check if simulation mode is enabled
-    if os.getenv('SIMULATE_POWER_EVENT', '').lower() == 'true':
+    if SIMULATE_POWER_EVENT:
         app.logger.info("Simulating power event")
         return simulate_power_event()
     
     try:
-        # Try using system apcaccess first
+        # Query apcupsd directly over its network information server
         try:
-            cmd = ['/sbin/apcaccess', '-h', os.getenv('APCUPSD_HOST', '10.0.0.13')]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)  # 10 second timeout
-            if result.returncode == 0:
-                # Parse the key-value output into a dictionary
-                status = {}
-                for line in result.stdout.split('\n'):
-                    if ':' in line:
-                        key, value = line.split(':', 1)
-                        status[key.strip()] = value.strip()
-
-                # Clean up values (remove units like Percent, Volts, etc.)
-                for key in status:
-                    if isinstance(status[key], str):
-                        status[key] = status[key].replace('Percent', '').replace('Volts', '').replace('Minutes', '').replace('Seconds', '').replace('Hz', '').replace('C', '').strip()
-
-                # Calculate power metrics
-                try:
-                    load_pct = float(status.get('LOADPCT', '0'))
-                    watts = calculate_watts(load_pct)
-                    voltage = float(status.get('LINEV', NOMINAL_VOLTAGE))
-                    amps = calculate_amps(watts, voltage)
-                    status['WATTS'] = f"{watts}"
-                    status['AMPS'] = f"{amps}"
-                    status['VOLTAGE'] = f"{voltage}"
-                    status['COST_HOUR'] = f"{calculate_power_cost(watts)}"
-                    status['COST_DAILY'] = f"{calculate_daily_cost(watts)}"
-                    status['COST_WEEKLY'] = f"{calculate_weekly_cost(watts)}"
-                    status['COST_MONTHLY'] = f"{calculate_monthly_cost(watts)}"
-                except ValueError:
-                    app.logger.warning("Could not calculate power metrics")
-
-                # Add configuration values
-                status['UPS_VA'] = UPS_VA
-                status['UPS_WATTS'] = UPS_WATTS
-                status['POWER_FACTOR'] = POWER_FACTOR
-                status['NOMINAL_VOLTAGE'] = NOMINAL_VOLTAGE
-                status['ELECTRICITY_RATE'] = ELECTRICITY_RATE
-
-                # Format any time durations
-                if 'TONBATT' in status:
-                    status['TONBATT_FORMATTED'] = format_duration(status['TONBATT'])
-                if 'CUMONBATT' in status:
-                    status['CUMONBATT_FORMATTED'] = format_duration(status['CUMONBATT'])
-
-                # Add timestamp
-                status['TIMESTAMP'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                return status
-        except (subprocess.SubprocessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
-            app.logger.warning(f"System apcaccess failed: {str(e)}, falling back to Python package")
-            app.logger.error(f"UPS connection issue - system apcaccess: {str(e)}")
+            return _enrich(ups_client.fetch())
+        except OSError as e:
+            app.logger.warning(f"apcupsd NIS query failed: {str(e)}, falling back to system apcaccess")
+            app.logger.error(f"UPS connection issue - NIS client: {str(e)}")
 
-        # Fall back to Python apcaccess package
+        # Fall back to system apcaccess
         try:
-            from apcaccess import status as apc
-            import socket
-            
-            # Set socket timeout for the connection
-            socket.setdefaulttimeout(10)
-            
-            ups = apc.parse(apc.get(
-                host=os.getenv('APCUPSD_HOST', '10.0.0.13'),
-                port=int(os.getenv('APCUPSD_PORT', 3551))
-            ))
-
-            # Clean up values
-            for key in ups:
-                if isinstance(ups[key], str):
-                    ups[key] = ups[key].replace('Percent', '').replace('Volts', '').replace('Minutes', '').replace('Seconds', '').replace('Hz', '').replace('C', '').strip()
-
-            # Calculate power metrics
-            try:
-                load_pct = float(ups.get('LOADPCT', '0'))
-                watts = calculate_watts(load_pct)
-                voltage = float(ups.get('LINEV', NOMINAL_VOLTAGE))
-                amps = calculate_amps(watts, voltage)
-                ups['WATTS'] = f"{watts}"
-                ups['AMPS'] = f"{amps}"
-                ups['VOLTAGE'] = f"{voltage}"
-                ups['COST_HOUR'] = f"{calculate_power_cost(watts)}"
-                ups['COST_DAILY'] = f"{calculate_daily_cost(watts)}"
-                ups['COST_WEEKLY'] = f"{calculate_weekly_cost(watts)}"
-                ups['COST_MONTHLY'] = f"{calculate_monthly_cost(watts)}"
-            except ValueError:
-                app.logger.warning("Could not calculate power metrics")
-
-            # Add configuration values
-            ups['UPS_VA'] = UPS_VA
-            ups['UPS_WATTS'] = UPS_WATTS
-            ups['POWER_FACTOR'] = POWER_FACTOR
-            ups['NOMINAL_VOLTAGE'] = NOMINAL_VOLTAGE
-            ups['ELECTRICITY_RATE'] = ELECTRICITY_RATE
-            
-            # Format any time durations
-            if 'TONBATT' in ups:
-                ups['TONBATT_FORMATTED'] = format_duration(ups['TONBATT'])
-            if 'CUMONBATT' in ups:
-                ups['CUMONBATT_FORMATTED'] = format_duration(ups['CUMONBATT'])
-
-            # Add timestamp
-            ups['TIMESTAMP'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-            return ups
-        except Exception as e:
-            app.logger.error(f"Error using Python apcaccess: {str(e)}")
-            app.logger.error(f"UPS connection issue - Python apcaccess: {str(e)}")
+            cmd = ['/sbin/apcaccess', '-h', f"{APCUPSD_HOST}:{APCUPSD_PORT}"]
+            result = subprocess.run(cmd, capture_output=True, timeout=10)  # 10 second timeout
+            if result.returncode != 0:
+                app.logger.error(f"System apcaccess exited with code {result.returncode}")
+                return None
+
+            # Parse the raw key-value output without decoding it first
+            return _enrich(parse_status(result.stdout.split(b'\n')))
+        except (subprocess.SubprocessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
+            app.logger.error(f"Error using system apcaccess: {str(e)}")
+            app.logger.error(f"UPS connection issue - system apcaccess: {str(e)}")
             return None
 
     except Exception as e:
@@ -259,6 +240,7 @@ def get_ups_status():
         return None
 
 @app.route('/')
+@compress.compressed()
 def index():
     """Render the main page."""
     return render_template('index.html')
@@ -267,22 +249,33 @@ def index():
 def status():
     """API endpoint to get UPS status."""
     try:
-        ups_status = get_ups_status()
+        ups_status, etag = _status_snapshot()
         if ups_status is None:
             return jsonify({'error': 'Failed to get UPS status - no data available'}), 503
-        return jsonify(ups_status)
+
+        # Browsers polling faster than the cache refreshes already hold this snapshot
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify(ups_status)
+        response.set_etag(etag, weak=True)
+        # Status is cached server-side for a couple of seconds anyway
+        response.headers['Cache-Control'] = 'max-age=1'
+        return response
     except Exception as e:
         app.logger.error(f"Error in status endpoint: {str(e)}")
         return jsonify({'error': f'UPS status error: {str(e)}'}), 500
 
 @app.route('/api/history')
+@compress.compressed()
 def history():
     """Get historical readings."""
     try:
         hours = float(request.args.get('hours', 24))
         hours = min(max(0.0833, hours), 720)  # Limit between 5 minutes (0.0833 hours) and 30 days
         readings = database.get_readings(hours=hours)
-        return jsonify(readings)
+        # Encode directly; history is the largest payload the app serves
+        return Response(orjson.dumps(readings), mimetype='application/json')
     except Exception as e:
         app.logger.error(f"Error getting history: {str(e)}")
         return jsonify({'error': 'Failed to get history'}), 500
@@ -305,7 +298,11 @@ def power_stats():
     try:
         days = int(request.args.get('days', 7))
         days = min(max(1, days), 30)  # Limit between 1 and 30 days
+        cached = _stats_cache.get(days)
+        if cached and time.monotonic() - cached[0] < STATS_CACHE_TTL:
+            return jsonify(cached[1])
         stats = database.get_power_statistics(days=days)
+        _stats_cache[days] = (time.monotonic(), stats)
         return jsonify(stats)
     except Exception as e:
         app.logger.error(f"Error getting power statistics: {str(e)}")
@@ -321,7 +318,7 @@ def health():
             return jsonify({
                 'status': 'unhealthy',
                 'message': 'Cannot connect to UPS',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': _now_iso()
             }), 503
         
         # Check if we have recent data
@@ -330,13 +327,13 @@ def health():
             return jsonify({
                 'status': 'warning',
                 'message': 'No recent data in database',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': _now_iso()
             }), 200
         
         return jsonify({
             'status': 'healthy',
             'message': 'UPS connection working',
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': _now_iso(),
             'last_reading': recent_readings[-1]['timestamp'] if recent_readings else None
         }), 200
         
@@ -345,7 +342,7 @@ def health():
         return jsonify({
             'status': 'error',
             'message': f'Health check failed: {str(e)}',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': _now_iso()
         }), 500
 
 @app.route('/api/events/acknowledge', methods=['POST'])
@@ -356,20 +353,20 @@ def acknowledge_events():
             return jsonify({
                 'status': 'success',
                 'message': 'Power events cleared successfully',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': _now_iso()
             }), 200
         else:
             return jsonify({
                 'status': 'error',
                 'message': 'Failed to clear power events',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': _now_iso()
             }), 500
     except Exception as e:
         app.logger.error(f"Error clearing power events: {str(e)}")
         return jsonify({
             'status': 'error',
             'message': f'Failed to clear power events: {str(e)}',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': _now_iso()
         }), 500
 
 if __name__ == '__main__':
@@ -5,17 +5,23 @@ Continuously polls the UPS and stores data in the database.
 This runs independently of the web interface.
 """
 
+import logging
 import os
+import signal
+import threading
 import time
 import subprocess
 import json
 from datetime import datetime
 from dotenv import load_dotenv
 import database
+from apc_client import ApcClient, parse_status
 
 # Load environment variables
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # UPS Configuration
 UPS_VA = int(os.getenv('UPS_VA', 3000))
 UPS_WATTS = int(os.getenv('UPS_WATTS', 2700))
@@ -23,6 +29,29 @@ POWER_FACTOR = float(os.getenv('POWER_FACTOR', 0.9))
 NOMINAL_VOLTAGE = int(os.getenv('NOMINAL_VOLTAGE', 120))
 ELECTRICITY_RATE = float(os.getenv('ELECTRICITY_RATE', 0.124))
 
+# Cost of drawing one watt for an hour, day, week (24 * 7 hours) and
+# average month (24 * 365.242 / 12 hours)
+_COST_PER_WATT_HOUR = ELECTRICITY_RATE / 1000
+_COST_PER_WATT_DAY = _COST_PER_WATT_HOUR * 24
+_COST_PER_WATT_WEEK = _COST_PER_WATT_HOUR * 168
+_COST_PER_WATT_MONTH = _COST_PER_WATT_HOUR * 730.484
+
+# Configuration values added to every reading
+_CONFIG_FIELDS = {
+    'UPS_VA': UPS_VA,
+    'UPS_WATTS': UPS_WATTS,
+    'POWER_FACTOR': POWER_FACTOR,
+    'NOMINAL_VOLTAGE': NOMINAL_VOLTAGE,
+    'ELECTRICITY_RATE': ELECTRICITY_RATE,
+}
+
+# apcupsd Network Information Server
+APCUPSD_HOST = os.getenv('APCUPSD_HOST', '10.0.0.13')
+APCUPSD_PORT = int(os.getenv('APCUPSD_PORT', 3551))
+
+# Kept open between polls so each reading is a single request/response
+ups_client = ApcClient(APCUPSD_HOST, APCUPSD_PORT)
+
 def calculate_watts(load_percent):
     """Calculate watts from load percentage."""
     try:
@@ -40,209 +69,180 @@ def calculate_amps(watts, voltage=120):
 
 def calculate_power_cost(watts):
     """Calculate hourly power cost."""
-    try:
-        return round((watts / 1000) * ELECTRICITY_RATE, 3)
-    except (ValueError, TypeError):
-        return 0.0
+    return round(watts * _COST_PER_WATT_HOUR, 3)
 
 def calculate_daily_cost(watts):
     """Calculate daily power cost."""
-    try:
-        return round((watts / 1000) * ELECTRICITY_RATE * 24, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    return round(watts * _COST_PER_WATT_DAY, 2)
 
 def calculate_weekly_cost(watts):
     """Calculate weekly power cost."""
-    try:
-        return round((watts / 1000) * ELECTRICITY_RATE * 168, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    return round(watts * _COST_PER_WATT_WEEK, 2)
 
 def calculate_monthly_cost(watts):
     """Calculate monthly power cost."""
-    try:
-        return round((watts / 1000) * ELECTRICITY_RATE * 730.484, 2)
-    except (ValueError, TypeError):
-        return 0.0
+    return round(watts * _COST_PER_WATT_MONTH, 2)
 
 def format_duration(seconds):
     """Format duration in seconds to HH:MM:SS."""
     try:
         seconds = int(seconds)
-        if seconds == 0:
-            return "None"
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        secs = seconds % 60
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
     except (ValueError, TypeError):
         return "Unknown"
+    if seconds == 0:
+        return "None"
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+def _postprocess(status, timestamp):
+    """Add the computed power metrics, configuration and timestamp to a parsed status."""
+    # Calculate power metrics
+    try:
+        load_pct = float(status.get('LOADPCT', '0'))
+        watts = calculate_watts(load_pct)
+        voltage = float(status.get('LINEV', NOMINAL_VOLTAGE))
+        status.update(
+            WATTS=f"{watts}",
+            AMPS=f"{calculate_amps(watts, voltage)}",
+            VOLTAGE=f"{voltage}",
+            COST_HOUR=f"{calculate_power_cost(watts)}",
+            COST_DAILY=f"{calculate_daily_cost(watts)}",
+            COST_WEEKLY=f"{calculate_weekly_cost(watts)}",
+            COST_MONTHLY=f"{calculate_monthly_cost(watts)}"
+        )
+    except ValueError:
+        log.warning("Could not calculate power metrics")
+
+    # Add configuration values and the timestamp
+    status.update(_CONFIG_FIELDS, TIMESTAMP=timestamp)
+
+    # Format any time durations
+    if 'TONBATT' in status:
+        status['TONBATT_FORMATTED'] = format_duration(status['TONBATT'])
+    if 'CUMONBATT' in status:
+        status['CUMONBATT_FORMATTED'] = format_duration(status['CUMONBATT'])
+
+    return status
+
+def get_ups_data(timestamp=None):
+    """Get UPS data and return processed status, stamped with timestamp if given."""
+    if timestamp is None:
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-def get_ups_data():
-    """Get UPS data and return processed status."""
     try:
-        # Try using system apcaccess first
-        try:
-            cmd = ['/sbin/apcaccess', '-h', os.getenv('APCUPSD_HOST', '10.0.0.13')]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                # Parse the key-value output into a dictionary
-                status = {}
-                for line in result.stdout.split('\n'):
-                    if ':' in line:
-                        key, value = line.split(':', 1)
-                        status[key.strip()] = value.strip()
-
-                # Clean up values
-                for key in status:
-                    if isinstance(status[key], str):
-                        status[key] = status[key].replace('Percent', '').replace('Volts', '').replace('Minutes', '').replace('Seconds', '').replace('Hz', '').replace('C', '').strip()
-
-                # Calculate power metrics
-                try:
-                    load_pct = float(status.get('LOADPCT', '0'))
-                    watts = calculate_watts(load_pct)
-                    voltage = float(status.get('LINEV', NOMINAL_VOLTAGE))
-                    amps = calculate_amps(watts, voltage)
-                    status['WATTS'] = f"{watts}"
-                    status['AMPS'] = f"{amps}"
-                    status['VOLTAGE'] = f"{voltage}"
-                    status['COST_HOUR'] = f"{calculate_power_cost(watts)}"
-                    status['COST_DAILY'] = f"{calculate_daily_cost(watts)}"
-                    status['COST_WEEKLY'] = f"{calculate_weekly_cost(watts)}"
-                    status['COST_MONTHLY'] = f"{calculate_monthly_cost(watts)}"
-                except ValueError:
-                    print(f"Warning: Could not calculate power metrics")
-
-                # Add configuration values
-                status['UPS_VA'] = UPS_VA
-                status['UPS_WATTS'] = UPS_WATTS
-                status['POWER_FACTOR'] = POWER_FACTOR
-                status['NOMINAL_VOLTAGE'] = NOMINAL_VOLTAGE
-                status['ELECTRICITY_RATE'] = ELECTRICITY_RATE
-
-                # Format any time durations
-                if 'TONBATT' in status:
-                    status['TONBATT_FORMATTED'] = format_duration(status['TONBATT'])
-                if 'CUMONBATT' in status:
-                    status['CUMONBATT_FORMATTED'] = format_duration(status['CUMONBATT'])
-
-                # Add timestamp
-                status['TIMESTAMP'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                return status
-        except (subprocess.SubprocessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
-            print(f"System apcaccess failed: {str(e)}, falling back to Python package")
-
-        # Fall back to Python apcaccess package
+        # Query apcupsd over the persistent NIS connection
         try:
-            from apcaccess import status as apc
-            import socket
-            
-            # Set socket timeout for the connection
-            socket.setdefaulttimeout(10)
-            
-            ups = apc.parse(apc.get(
-                host=os.getenv('APCUPSD_HOST', '10.0.0.13'),
-                port=int(os.getenv('APCUPSD_PORT', 3551))
-            ))
+            status = ups_client.fetch()
+        except OSError as e:
+            log.warning("NIS query failed: %s, falling back to system apcaccess", e)
 
-            # Clean up values
-            for key in ups:
-                if isinstance(ups[key], str):
-                    ups[key] = ups[key].replace('Percent', '').replace('Volts', '').replace('Minutes', '').replace('Seconds', '').replace('Hz', '').replace('C', '').strip()
-
-            # Calculate power metrics
+            # Fall back to the apcaccess binary
             try:
-                load_pct = float(ups.get('LOADPCT', '0'))
-                watts = calculate_watts(load_pct)
-                voltage = float(ups.get('LINEV', NOMINAL_VOLTAGE))
-                amps = calculate_amps(watts, voltage)
-                ups['WATTS'] = f"{watts}"
-                ups['AMPS'] = f"{amps}"
-                ups['VOLTAGE'] = f"{voltage}"
-                ups['COST_HOUR'] = f"{calculate_power_cost(watts)}"
-                ups['COST_DAILY'] = f"{calculate_daily_cost(watts)}"
-                ups['COST_WEEKLY'] = f"{calculate_weekly_cost(watts)}"
-                ups['COST_MONTHLY'] = f"{calculate_monthly_cost(watts)}"
-            except ValueError:
-                print(f"Warning: Could not calculate power metrics")
-
-            # Add configuration values
-            ups['UPS_VA'] = UPS_VA
-            ups['UPS_WATTS'] = UPS_WATTS
-            ups['POWER_FACTOR'] = POWER_FACTOR
-            ups['NOMINAL_VOLTAGE'] = NOMINAL_VOLTAGE
-            ups['ELECTRICITY_RATE'] = ELECTRICITY_RATE
-            
-            # Format any time durations
-            if 'TONBATT' in ups:
-                ups['TONBATT_FORMATTED'] = format_duration(ups['TONBATT'])
-            if 'CUMONBATT' in ups:
-                ups['CUMONBATT_FORMATTED'] = format_duration(ups['CUMONBATT'])
-
-            # Add timestamp
-            ups['TIMESTAMP'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-            return ups
-        except Exception as e:
-            print(f"Error using Python apcaccess: {str(e)}")
-            return None
+                cmd = ['/sbin/apcaccess', '-h', f"{APCUPSD_HOST}:{APCUPSD_PORT}"]
+                result = subprocess.run(cmd, capture_output=True, timeout=10)
+            except (subprocess.SubprocessError, FileNotFoundError) as e:
+                log.error("System apcaccess failed: %s", e)
+                return None
+            if result.returncode != 0:
+                log.error("System apcaccess exited with status %d", result.returncode)
+                return None
+            status = parse_status(result.stdout.split(b'\n'))
+
+        return _postprocess(status, timestamp)
 
     except Exception as e:
-        print(f"Error getting UPS status: {str(e)}")
+        log.error("Error getting UPS status: %s", e)
         return None
 
+# Set by SIGTERM/SIGINT; the collection loop finishes its current poll and exits
+_stop = threading.Event()
+
+def _request_stop(signum, frame):
+    """Signal handler asking the collection loop to stop."""
+    _stop.set()
+
+def cleanup_loop(interval):
+    """Remove old readings every interval seconds, off the collection loop."""
+    while True:
+        try:
+            database.cleanup_old_readings(days=7)
+            log.info("Cleaned up old readings")
+        except Exception as e:
+            log.error("Cleanup failed: %s", e)
+        time.sleep(interval)
+
 def main():
     """Main data collection loop."""
-    print("Starting UPS Data Collector...")
+    # One line per record on stderr, which systemd hands to the journal
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    log.info("Starting UPS Data Collector...")
     
     # Initialize database
     database.init_db()
     
     # Data collection interval (seconds)
     COLLECTION_INTERVAL = 5
+
+    # Clean up old readings every 30 minutes on a background thread
+    CLEANUP_INTERVAL = 30 * 60
+    threading.Thread(target=cleanup_loop, args=(CLEANUP_INTERVAL,), daemon=True).start()
+    
+    # Stop between polls on systemd's SIGTERM or Ctrl+C rather than raising
+    # mid-write, so the queued readings are flushed exactly once
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
     
     consecutive_failures = 0
     max_failures = 10
+
+    # Polls run on a fixed monotonic schedule, so the time spent querying
+    # the UPS and writing to the database does not stretch the interval
+    next_poll = time.monotonic()
     
-    while True:
+    while not _stop.is_set():
+        # One clock reading per poll for the reading and its stored timestamp
+        now = int(time.time())
+        now_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
         try:
             # Get UPS data
-            ups_data = get_ups_data()
+            ups_data = get_ups_data(now_str)
             
             if ups_data and ups_data.get('STATUS'):
-                # Store the reading
-                database.store_reading(ups_data)
+                # Queued; database writes the readings in batches
+                database.store_reading(ups_data, timestamp=now)
                 consecutive_failures = 0
                 
                 # Log successful collection
-                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Data collected: {ups_data.get('STATUS')} - Load: {ups_data.get('LOADPCT')}% - Watts: {ups_data.get('WATTS')}")
-                
-                # Clean up old readings periodically (every 30 minutes)
-                if datetime.now().minute % 30 == 0 and datetime.now().second < 10:
-                    database.cleanup_old_readings(days=7)
-                    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Cleaned up old readings")
-                    
+                log.info("Data collected: %s - Load: %s%% - Watts: %s",
+                         ups_data.get('STATUS'), ups_data.get('LOADPCT'), ups_data.get('WATTS'))
             else:
                 consecutive_failures += 1
-                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Failed to get UPS data (attempt {consecutive_failures}/{max_failures})")
+                log.warning("Failed to get UPS data (attempt %d/%d)", consecutive_failures, max_failures)
                 
                 if consecutive_failures >= max_failures:
-                    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Too many consecutive failures, pausing for 60 seconds")
-                    time.sleep(60)
+                    log.error("Too many consecutive failures, pausing for 60 seconds")
+                    _stop.wait(60)
                     consecutive_failures = 0
-            
-            # Wait for next collection
-            time.sleep(COLLECTION_INTERVAL)
-            
-        except KeyboardInterrupt:
-            print("\nStopping UPS Data Collector...")
-            break
         except Exception as e:
-            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Unexpected error: {str(e)}")
-            time.sleep(COLLECTION_INTERVAL)
+            log.error("Unexpected error: %s", e)
+        
+        # Wait for next collection
+        next_poll += COLLECTION_INTERVAL
+        delay = next_poll - time.monotonic()
+        if delay > 0:
+            _stop.wait(delay)
+        else:
+            # Behind schedule (e.g. after the failure pause); start over
+            # from now instead of firing the missed polls back to back
+            next_poll = time.monotonic()
+        
+    log.info("Stopping UPS Data Collector...")
+    database.flush()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
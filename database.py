@@ -1,55 +1,566 @@
+import atexit
 import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import json
 import os
+from dotenv import load_dotenv
+
+# Stored readings are encoded with orjson when it is installed
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    # The collector does not otherwise need the web app's requirements
+    import json
+
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    _json_loads = json.loads
+
+# SQLite database shared by the web app and the data collector
+DB_PATH = 'ups_history.db'
+
+# Both entry points import this module before loading .env themselves
+load_dotenv()
+
+# Cost per kWh in dollars, and of one watt for an hour
+ELECTRICITY_RATE = float(os.getenv('ELECTRICITY_RATE', 0.124))
+_COST_PER_WATT_HOUR = ELECTRICITY_RATE / 1000
+
+# Per-thread long-lived connections, see get_connection() and
+# get_read_connection(); all of them are also tracked by (owning thread,
+# attribute) so they can be closed from elsewhere
+_local = threading.local()
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _connect(readonly=False):
+    """Open a database connection with the performance PRAGMAs applied."""
+    # Autocommit mode; writes open their transactions explicitly via _transaction().
+    # Each connection is only used by the thread that opened it, but may be
+    # closed by _close_all() from another thread. Every query here has fixed
+    # SQL text, so the long-lived connections prepare each statement once
+    if readonly:
+        # WAL lets readers run alongside the collector's writes; a read-only
+        # open also guards the dashboard queries against ever writing
+        conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA query_only=1')
+    else:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+    # These settings are per connection; WAL mode itself is stored in the
+    # database file by init_db()
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    # Bounds the sampling PRAGMA optimize does after cleanup
+    conn.execute('PRAGMA analysis_limit=1000')
+    return conn
+
+def _thread_connection(attr, readonly):
+    """Return the connection stored under attr for this thread, opening it on first use."""
+    conn = getattr(_local, attr, None)
+    if conn is None:
+        conn = _connect(readonly)
+        setattr(_local, attr, conn)
+        with _connections_lock:
+            # Close the connections of threads that have since exited
+            for key in [k for k in _connections if not k[0].is_alive()]:
+                _connections.pop(key).close()
+            _connections[threading.current_thread(), attr] = conn
+    return conn
+
+def get_connection():
+    """Return this thread's long-lived connection, opening it on first use."""
+    return _thread_connection('conn', False)
+
+def get_read_connection():
+    """Return this thread's long-lived read-only connection, for queries that never write."""
+    return _thread_connection('ro_conn', True)
+
+def _close_all():
+    """Close the connections no other thread can still be using, optimizing first."""
+    current = threading.current_thread()
+    with _connections_lock:
+        # Daemon threads may be mid-query at exit; closing their connections
+        # under them would crash the interpreter, so those are left open
+        for key in [k for k in _connections if k[0] is current or not k[0].is_alive()]:
+            conn = _connections.pop(key)
+            try:
+                # PRAGMA optimize may write statistics, which needs a writer
+                if key[1] == 'conn':
+                    conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+atexit.register(_close_all)
+
+@contextmanager
+def _transaction(conn):
+    """Run the enclosed writes as one transaction, taking the write lock up front."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+# Bump when the schema changes and add the upgrade step to _migrate()
+SCHEMA_VERSION = 9
+
+# Reading fields kept in their own typed columns so queries aggregate native
+# values; everything else stays in the JSON data column
+_COLUMN_FIELDS = (
+    ('WATTS', 'watts', 'REAL'),
+    ('AMPS', 'amps', 'REAL'),
+    ('LOADPCT', 'loadpct', 'REAL'),
+    ('BCHARGE', 'bcharge', 'REAL'),
+    ('NUMXFERS', 'numxfers', 'INTEGER'),
+    ('STATUS', 'status', 'TEXT'),
+)
+
+# Column list matching _COLUMN_FIELDS followed by the JSON remainder, see _reading_data()
+_READING_COLUMNS = 'watts, amps, loadpct, bcharge, numxfers, status, data'
+
+# Row shape produced by _reading_row(): timestamp, the typed columns, then the JSON remainder
+_INSERT_READING = f'INSERT INTO ups_readings (timestamp, {_READING_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+_INSERT_EVENT = f'INSERT OR IGNORE INTO power_events (timestamp, {_READING_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+
+# Static configuration the collector adds to each reading; it never changes
+# between rows and the live values are served by /api/status, so it is not stored
+_CONFIG_KEYS = ('UPS_VA', 'UPS_WATTS', 'POWER_FACTOR', 'NOMINAL_VOLTAGE', 'ELECTRICITY_RATE')
+
+# Preset zlib dictionary for the JSON remainder: a typical apcupsd report
+# after _reading_row() has taken out the typed columns and configuration, so
+# the keys and common values of even a single reading compress to
+# back-references. Stored data can only be decompressed with the dictionary
+# it was written with; do not change it
+_ZDICT = (
+    b'{"APC":"001,036,0879","DATE":"2024-01-01 00:00:00 -0500","HOSTNAME":"",'
+    b'"VERSION":"3.14.14 (31 May 2016) debian","UPSNAME":"","CABLE":"USB Cable",'
+    b'"DRIVER":"USB UPS Driver","UPSMODE":"Stand Alone","STARTTIME":"2024-01-01 00:00:00 -0500",'
+    b'"MODEL":"Smart-UPS 1500","LINEV":"120.0","TIMELEFT":"45.0","MBATTCHG":"5",'
+    b'"MINTIMEL":"3","MAXTIME":"0","OUTPUTV":"120.0","SENSE":"High","DWAKE":"0",'
+    b'"DSHUTD":"0","LOTRANS":"106.0","HITRANS":"127.0","RETPCT":"0.0","ITEMP":"22.5",'
+    b'"ALARMDEL":"30","BATTV":"27.0","LINEFREQ":"60.0",'
+    b'"LASTXFER":"Automatic or explicit self test","TONBATT":"0","CUMONBATT":"0",'
+    b'"XOFFBATT":"N/A","SELFTEST":"NO","STESTI":"14 days","STATFLAG":"0x05000008",'
+    b'"SERIALNO":"","BATTDATE":"2024-01-01","NOMINV":"120","NOMBATTV":"24.0",'
+    b'"NOMPOWER":"980","FIRMWARE":"","END APC":"2024-01-01 00:00:00 -0500",'
+    b'"VOLTAGE":"120.0","COST_HOUR":"0.0","COST_DAILY":"0.0","COST_WEEKLY":"0.0",'
+    b'"COST_MONTHLY":"0.0","TIMESTAMP":"2024-01-01 00:00:00",'
+    b'"TONBATT_FORMATTED":"None","CUMONBATT_FORMATTED":"None"}'
+)
+
+def _pack(obj):
+    """Encode a reading's JSON remainder as zlib-compressed JSON."""
+    compressor = zlib.compressobj(zdict=_ZDICT)
+    return compressor.compress(_json_dumps(obj)) + compressor.flush()
+
+def _unpack(blob):
+    """Decode data stored by _pack()."""
+    return _json_loads(zlib.decompressobj(zdict=_ZDICT).decompress(blob))
+
+# Plain INTEGER PRIMARY KEY: ids follow MAX(id) + 1 without the extra
+# sqlite_sequence write AUTOINCREMENT costs on every insert
+_READINGS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS ups_readings (
+        id INTEGER PRIMARY KEY,
+        timestamp INTEGER NOT NULL,
+        watts REAL,
+        amps REAL,
+        loadpct REAL,
+        bcharge REAL,
+        numxfers INTEGER,
+        status TEXT,
+        data BLOB NOT NULL
+    )
+'''
+
+# Per-bucket sums of the hot columns, maintained on insert by store_readings_batch()
+# so long-range history reads a few hundred precomputed rows
+_ROLLUP_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        bucket INTEGER PRIMARY KEY,
+        sum_watts REAL NOT NULL,
+        sum_amps REAL NOT NULL,
+        sum_load REAL NOT NULL,
+        sum_bcharge REAL NOT NULL,
+        samples INTEGER NOT NULL,
+        first_timestamp INTEGER NOT NULL,
+        last_timestamp INTEGER NOT NULL
+    )
+'''
+
+_ROLLUP_UPSERT = '''
+    INSERT INTO {table} (bucket, sum_watts, sum_amps, sum_load, sum_bcharge,
+                         samples, first_timestamp, last_timestamp)
+    VALUES (?, IFNULL(?, 0), IFNULL(?, 0), IFNULL(?, 0), IFNULL(?, 0), 1, ?, ?)
+    ON CONFLICT(bucket) DO UPDATE SET
+        sum_watts = sum_watts + excluded.sum_watts,
+        sum_amps = sum_amps + excluded.sum_amps,
+        sum_load = sum_load + excluded.sum_load,
+        sum_bcharge = sum_bcharge + excluded.sum_bcharge,
+        samples = samples + 1,
+        first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+        last_timestamp = MAX(last_timestamp, excluded.last_timestamp)
+'''
+
+def _bucket_start(timestamp, size):
+    """Start of the local-time interval of size seconds an epoch timestamp falls in."""
+    return timestamp - (timestamp + time.localtime(timestamp).tm_gmtoff) % size
+
+def _local_day(timestamp):
+    """Local calendar day of an epoch timestamp, e.g. '2024-01-01'."""
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+def _iso(timestamp):
+    """Local ISO 8601 form of an epoch timestamp, as returned by the API."""
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+# Rollup tables and their bucket size in seconds
+_ROLLUPS = (
+    ('ups_readings_hourly', 3600),
+    ('ups_readings_15m', 900),
+)
+
+# Hourly rollups outlive the raw readings so the 30-day history has data
+ROLLUP_RETENTION_DAYS = 30
+
+# Daily totals of the readings with a positive wattage, maintained on insert
+# so get_power_statistics() reads at most one row per day
+_STATS_DAILY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT PRIMARY KEY,
+        samples INTEGER NOT NULL,
+        sum_watts REAL NOT NULL,
+        min_watts REAL NOT NULL,
+        max_watts REAL NOT NULL,
+        sum_load REAL NOT NULL
+    )
+'''
+
+# Power events (transfers to battery) recorded as readings are stored, with a
+# copy of the reading so event queries never touch ups_readings
+_POWER_EVENTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS power_events (
+        timestamp INTEGER PRIMARY KEY,
+        watts REAL,
+        amps REAL,
+        loadpct REAL,
+        bcharge REAL,
+        numxfers INTEGER,
+        status TEXT,
+        data BLOB NOT NULL
+    )
+'''
+
+def _migrate(conn, version):
+    """Upgrade a database created by an older release to SCHEMA_VERSION."""
+    if version < 1:
+        # Move the hot fields out of the JSON blob into typed columns
+        for key, column, column_type in _COLUMN_FIELDS:
+            conn.execute(f'ALTER TABLE ups_readings ADD COLUMN {column} {column_type}')
+        conn.execute('''
+            UPDATE ups_readings SET
+                watts = CAST(json_extract(data, '$.WATTS') AS REAL),
+                amps = CAST(json_extract(data, '$.AMPS') AS REAL),
+                loadpct = CAST(json_extract(data, '$.LOADPCT') AS REAL),
+                bcharge = CAST(json_extract(data, '$.BCHARGE') AS REAL),
+                numxfers = CAST(json_extract(data, '$.NUMXFERS') AS INTEGER),
+                status = json_extract(data, '$.STATUS'),
+                data = json_remove(data, '$.WATTS', '$.AMPS', '$.LOADPCT',
+                                   '$.BCHARGE', '$.NUMXFERS', '$.STATUS')
+        ''')
+    if version < 2:
+        # Build the rollups from the readings already stored, which still
+        # have ISO 8601 timestamps at this point; step 7 gives the tables
+        # their final schema
+        for table, bucket_sql in (
+            ('ups_readings_hourly', "substr(timestamp, 1, 13) || ':00'"),
+            ('ups_readings_15m', "substr(timestamp, 1, 14) || "
+                                 "printf('%02d', CAST(substr(timestamp, 15, 2) AS INTEGER) / 15 * 15)"),
+        ):
+            conn.execute(f'''
+                CREATE TABLE {table} AS
+                SELECT {bucket_sql} AS bucket, TOTAL(watts) AS sum_watts, TOTAL(amps) AS sum_amps,
+                       TOTAL(loadpct) AS sum_load, TOTAL(bcharge) AS sum_bcharge, COUNT(*) AS samples,
+                       MIN(timestamp) AS first_timestamp, MAX(timestamp) AS last_timestamp
+                FROM ups_readings
+                GROUP BY 1
+            ''')
+    if version < 3:
+        # Drop the static configuration from the stored readings
+        conn.execute(f'''
+            UPDATE ups_readings
+            SET data = json_remove(data, {', '.join(f"'$.{key}'" for key in _CONFIG_KEYS)})
+        ''')
+    if version < 4:
+        # Record the events found in the stored readings; the index that
+        # served the old per-request event scan is no longer needed
+        conn.execute(f'''
+            CREATE TABLE power_events AS
+            SELECT timestamp, {_READING_COLUMNS}
+            FROM (
+                SELECT *, LAG(numxfers) OVER (ORDER BY timestamp) as prev_transfers
+                FROM ups_readings
+            )
+            WHERE (numxfers != prev_transfers AND prev_transfers IS NOT NULL)
+            OR status LIKE '%ONBATT%'
+        ''')
+        conn.execute('DROP INDEX IF EXISTS idx_ts_status')
+    if version < 5:
+        # The non-covering statistics index; statistics now come from
+        # stats_daily (version 6), so nothing recreates it
+        conn.execute('DROP INDEX IF EXISTS idx_ts_watts')
+    if version < 6:
+        # Build the daily statistics from the readings already stored; the
+        # index that served the per-request statistics scan is not needed
+        conn.execute(_STATS_DAILY_SCHEMA)
+        conn.execute('''
+            INSERT INTO stats_daily
+            SELECT substr(timestamp, 1, 10), COUNT(*), SUM(watts), MIN(watts), MAX(watts), TOTAL(loadpct)
+            FROM ups_readings
+            WHERE watts > 0
+            GROUP BY 1
+        ''')
+        conn.execute('DROP INDEX IF EXISTS idx_ts_watts')
+    if version < 7:
+        # Convert local ISO 8601 timestamps to Unix epoch seconds
+        epoch = "CAST(strftime('%s', {}, 'utc') AS INTEGER)"
+        conn.execute(f'''
+            UPDATE ups_readings SET timestamp = {epoch.format('timestamp')}
+        ''')
+        conn.execute(f'''
+            UPDATE OR REPLACE acknowledged_events
+            SET event_timestamp = {epoch.format('event_timestamp')},
+                acknowledged_at = {epoch.format('acknowledged_at')}
+        ''')
+        # Tables keyed by time get an INTEGER primary key, which needs a
+        # new table
+        for table, schema, columns in (
+            ('power_events', _POWER_EVENTS_SCHEMA,
+             f"{epoch.format('timestamp')}, {_READING_COLUMNS}"),
+            *((table, _ROLLUP_SCHEMA.format(table=table),
+               f"{epoch.format('bucket')}, sum_watts, sum_amps, sum_load, sum_bcharge, samples, "
+               f"{epoch.format('first_timestamp')}, {epoch.format('last_timestamp')}")
+              for table, size in _ROLLUPS),
+        ):
+            conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            conn.execute(schema)
+            conn.execute(f'INSERT OR IGNORE INTO {table} SELECT {columns} FROM {table}_old')
+            conn.execute(f'DROP TABLE {table}_old')
+    if version < 8:
+        # Rebuild the readings without AUTOINCREMENT; init_db() recreates
+        # the timestamp index dropped with the old table
+        conn.execute('ALTER TABLE ups_readings RENAME TO ups_readings_old')
+        conn.execute(_READINGS_SCHEMA)
+        conn.execute(f'''
+            INSERT INTO ups_readings (id, timestamp, {_READING_COLUMNS})
+            SELECT id, timestamp, {_READING_COLUMNS} FROM ups_readings_old
+        ''')
+        conn.execute('DROP TABLE ups_readings_old')
+    if version < 9:
+        # Compress the JSON remainder of the stored readings and events; the
+        # tables keep their declared column type, which does not affect BLOBs
+        for table in ('ups_readings', 'power_events'):
+            conn.executemany(f'UPDATE {table} SET data = ? WHERE rowid = ?', [
+                (_pack(_json_loads(data)), rowid)
+                for rowid, data in conn.execute(f'SELECT rowid, data FROM {table}')
+            ])
 
 def init_db():
     """Initialize the database with required tables."""
-    conn = sqlite3.connect('ups_history.db')
-    c = conn.cursor()
-    
-    # Create table for raw UPS readings
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS ups_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME NOT NULL,
-            data JSON NOT NULL
-        )
-    ''')
-    
-    # Create index on timestamp for faster queries
-    c.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON ups_readings(timestamp)')
-    
-    # Create table for acknowledged events
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS acknowledged_events (
-            event_timestamp DATETIME PRIMARY KEY,
-            acknowledged_at DATETIME NOT NULL
-        )
-    ''')
-    
-    conn.commit()
+    conn = _connect()
+
+    # Write-ahead logging lets the web app read while the collector writes,
+    # and with synchronous=NORMAL each commit needs a single fsync at most
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    # The app and the collector may start together; the write lock makes
+    # sure only one of them runs the migration
+    with _transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        existing = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ups_readings'"
+        ).fetchone()
+        if existing and version < SCHEMA_VERSION:
+            _migrate(conn, version)
+
+        # Create table for UPS readings
+        conn.execute(_READINGS_SCHEMA)
+
+        # Create index on timestamp for faster queries
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON ups_readings(timestamp)')
+
+        # Create the hourly and 15-minute rollup tables
+        for table, size in _ROLLUPS:
+            conn.execute(_ROLLUP_SCHEMA.format(table=table))
+
+        # Create table for daily power statistics
+        conn.execute(_STATS_DAILY_SCHEMA)
+
+        # Create table for power events
+        conn.execute(_POWER_EVENTS_SCHEMA)
+
+        # Create table for acknowledged events
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS acknowledged_events (
+                event_timestamp INTEGER PRIMARY KEY,
+                acknowledged_at INTEGER NOT NULL
+            )
+        ''')
+
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
     conn.close()
 
-def store_reading(data):
-    """Store a UPS reading in the database."""
-    conn = sqlite3.connect('ups_history.db')
-    c = conn.cursor()
-    
-    c.execute(
-        'INSERT INTO ups_readings (timestamp, data) VALUES (?, ?)',
-        (datetime.now().isoformat(), json.dumps(data))
-    )
+def _reading_row(timestamp, data):
+    """Split a reading into (timestamp, typed column values..., JSON remainder)."""
+    rest = dict(data)
+    for key in _CONFIG_KEYS:
+        rest.pop(key, None)
+    values = []
+    for key, column, column_type in _COLUMN_FIELDS:
+        value = rest.pop(key, None)
+        if value is not None and column_type != 'TEXT':
+            try:
+                value = int(float(value)) if column_type == 'INTEGER' else float(value)
+            except ValueError:
+                # Keep unparseable values in the JSON rather than dropping them
+                rest[key] = value
+                value = None
+        values.append(value)
+    return (timestamp, *values, _pack(rest))
+
+def _reading_data(row):
+    """Rebuild a reading dict from a row selected with _READING_COLUMNS."""
+    data = _unpack(row[-1])
+    for (key, column, column_type), value in zip(_COLUMN_FIELDS, row):
+        if value is not None:
+            data[key] = value
+    return data
+
+def store_readings_batch(readings, conn=None):
+    """Store (timestamp, data) pairs in the database in a single transaction."""
+    conn = conn or get_connection()
     
-    conn.commit()
-    conn.close()
+    with _transaction(conn):
+        rows = [_reading_row(timestamp, data) for timestamp, data in readings]
+
+        # A reading is a power event if the transfer count changed since the
+        # previous reading or the UPS is on battery
+        last = conn.execute('SELECT numxfers FROM ups_readings ORDER BY timestamp DESC LIMIT 1').fetchone()
+        prev_transfers = last[0] if last else None
+        events = []
+        for row in rows:
+            numxfers, status = row[5], row[6]
+            if ((numxfers is not None and prev_transfers is not None and numxfers != prev_transfers)
+                    or (status and 'ONBATT' in status)):
+                events.append(row)
+            prev_transfers = numxfers
+
+        conn.executemany(_INSERT_READING, rows)
+        for table, size in _ROLLUPS:
+            conn.executemany(
+                _ROLLUP_UPSERT.format(table=table),
+                [(_bucket_start(row[0], size), *row[1:5], row[0], row[0]) for row in rows]
+            )
+        conn.executemany('''
+            INSERT INTO stats_daily (day, samples, sum_watts, min_watts, max_watts, sum_load)
+            VALUES (?, 1, ?, ?, ?, IFNULL(?, 0))
+            ON CONFLICT(day) DO UPDATE SET
+                samples = samples + 1,
+                sum_watts = sum_watts + excluded.sum_watts,
+                min_watts = MIN(min_watts, excluded.min_watts),
+                max_watts = MAX(max_watts, excluded.max_watts),
+                sum_load = sum_load + excluded.sum_load
+        ''', [(_local_day(row[0]), row[1], row[1], row[1], row[3]) for row in rows if row[1] and row[1] > 0])
+        if events:
+            conn.executemany(_INSERT_EVENT, events)
+
+
+# Write-behind buffer of (epoch timestamp, data) readings, see store_reading().
+# It is written once FLUSH_SIZE readings are queued (a minute of 5-second
+# polls) or FLUSH_INTERVAL seconds after the first one, whichever is sooner
+FLUSH_SIZE = 12
+FLUSH_INTERVAL = 60
+_pending = deque()
+_pending_lock = threading.Lock()
+_pending_ready = threading.Condition(_pending_lock)
+_flush_lock = threading.Lock()
+# Monotonic time the oldest queued reading was added, and the writer thread
+_first_queued = 0.0
+_writer = None
+
+def _writer_loop():
+    """Flush the buffer whenever it fills or its oldest reading has waited FLUSH_INTERVAL."""
+    # A single long-lived thread, so these writes reuse one connection
+    while True:
+        with _pending_ready:
+            _pending_ready.wait_for(lambda: _pending)
+            _pending_ready.wait_for(lambda: len(_pending) >= FLUSH_SIZE or not _pending,
+                                    timeout=_first_queued + FLUSH_INTERVAL - time.monotonic())
+        try:
+            flush()
+        except Exception as e:
+            print(f"Error writing queued readings: {e}")
+            # The batch is requeued; retry after a pause rather than spinning
+            time.sleep(FLUSH_INTERVAL)
+
+def store_reading(data, timestamp=None):
+    """Queue a UPS reading; queued readings are written together by flush()."""
+    global _first_queued, _writer
+    with _pending_ready:
+        if not _pending:
+            _first_queued = time.monotonic()
+        _pending.append((timestamp or int(time.time()), data))
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name='reading-writer', daemon=True)
+            _writer.start()
+        _pending_ready.notify()
+
+def flush():
+    """Write all queued readings in a single transaction."""
+    # Batches are written one at a time and in order; power event detection
+    # compares each batch with the reading stored before it
+    with _flush_lock:
+        with _pending_lock:
+            batch = list(_pending)
+            _pending.clear()
+        if not batch:
+            return
+        try:
+            store_readings_batch(batch)
+        except Exception:
+            # Requeue ahead of newer readings so the next flush retries them.
+            # Errors are raised before COMMIT; anything else (KeyboardInterrupt)
+            # may land after it, and requeueing then would store the batch twice
+            with _pending_lock:
+                _pending.extendleft(reversed(batch))
+            raise
+
+# Runs before _close_all(), which was registered first
+atexit.register(flush)
 
 def get_readings(hours=24, max_points=200):
     """Get readings from the last N hours with data aggregation for longer periods."""
-    conn = sqlite3.connect('ups_history.db')
+    conn = get_read_connection()
     c = conn.cursor()
     
-    cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+    cutoff = int(time.time() - hours * 3600)
     
     # Initialize readings list
     readings = []
@@ -57,111 +568,86 @@ def get_readings(hours=24, max_points=200):
     # Calculate the start time for the requested period
     start_time = datetime.now() - timedelta(hours=hours)
     
-    # For longer periods, use aggregation to reduce data points
-    if hours > 168:  # 7 days or more - use hourly aggregation
-        # Use hourly intervals for periods longer than 7 days
-        c.execute('''
-            SELECT 
-                strftime('%Y-%m-%d %H:00', timestamp, 'localtime') as time_bucket,
-                AVG(CAST(json_extract(data, '$.WATTS') AS FLOAT)) as avg_watts,
-                AVG(CAST(json_extract(data, '$.AMPS') AS FLOAT)) as avg_amps,
-                AVG(CAST(json_extract(data, '$.LOADPCT') AS FLOAT)) as avg_load,
-                AVG(CAST(json_extract(data, '$.BCHARGE') AS FLOAT)) as avg_battery,
-                COUNT(*) as sample_count,
-                MIN(timestamp) as first_timestamp,
-                MAX(timestamp) as last_timestamp
-            FROM ups_readings 
-            WHERE timestamp > ?
-            GROUP BY time_bucket
-            ORDER BY time_bucket
-        ''', (cutoff,))
-        
-        rows = c.fetchall()
-        
-        # Limit to max_points and sample evenly
-        if len(rows) > max_points:
-            step = len(rows) // max_points
-            rows = rows[::step][:max_points]
-        
-        for row in rows:
-            # Create aggregated data structure
-            aggregated_data = {
-                'WATTS': round(row[1], 1) if row[1] else 0,
-                'AMPS': round(row[2], 2) if row[2] else 0,
-                'LOADPCT': round(row[3], 1) if row[3] else 0,
-                'BCHARGE': round(row[4], 1) if row[4] else 0,
-                'SAMPLE_COUNT': row[5]
-            }
-            
-            readings.append({
-                'timestamp': row[6],  # Use first timestamp of the bucket
-                'data': aggregated_data
-            })
-    elif hours > 72:  # 3-7 days - use 15-minute intervals
-        # Use 15-minute intervals (00, 15, 30, 45) for periods 3-7 days
-        c.execute('''
-            SELECT 
-                strftime('%Y-%m-%d %H:00', timestamp, 'localtime') || 
-                CASE 
-                    WHEN CAST(strftime('%M', timestamp, 'localtime') AS INTEGER) < 15 THEN ':00'
-                    WHEN CAST(strftime('%M', timestamp, 'localtime') AS INTEGER) < 30 THEN ':15'
-                    WHEN CAST(strftime('%M', timestamp, 'localtime') AS INTEGER) < 45 THEN ':30'
-                    ELSE ':45'
-                END as time_bucket,
-                AVG(CAST(json_extract(data, '$.WATTS') AS FLOAT)) as avg_watts,
-                AVG(CAST(json_extract(data, '$.AMPS') AS FLOAT)) as avg_amps,
-                AVG(CAST(json_extract(data, '$.LOADPCT') AS FLOAT)) as avg_load,
-                AVG(CAST(json_extract(data, '$.BCHARGE') AS FLOAT)) as avg_battery,
-                COUNT(*) as sample_count,
-                MIN(timestamp) as first_timestamp,
-                MAX(timestamp) as last_timestamp
-            FROM ups_readings 
-            WHERE timestamp > ?
-            GROUP BY time_bucket
+    # For longer periods, read the precomputed rollups to reduce data points
+    if hours > 72:
+        # Hourly intervals beyond 7 days, 15-minute intervals (00, 15, 30, 45) for 3-7 days
+        table, size = _ROLLUPS[0] if hours > 168 else _ROLLUPS[1]
+        # Buckets are sampled evenly down to max_points in SQL, so only the
+        # returned rows cross into Python
+        c.execute(f'''
+            SELECT
+                time_bucket,
+                avg_watts,
+                avg_amps,
+                avg_load,
+                avg_battery,
+                sample_count,
+                first_timestamp,
+                last_timestamp,
+                ROUND(avg_watts * ?, 3) as cost_hour,
+                ROUND(avg_watts * ? * 24, 2) as cost_daily
+            FROM (
+                SELECT 
+                    bucket as time_bucket,
+                    sum_watts / samples as avg_watts,
+                    sum_amps / samples as avg_amps,
+                    sum_load / samples as avg_load,
+                    sum_bcharge / samples as avg_battery,
+                    samples as sample_count,
+                    first_timestamp,
+                    last_timestamp,
+                    ROW_NUMBER() OVER (ORDER BY bucket) - 1 as rn,
+                    COUNT(*) OVER () as total
+                FROM {table}
+                WHERE bucket >= ?
+            )
+            WHERE total <= ? OR rn % (total / ?) = 0
             ORDER BY time_bucket
-        ''', (cutoff,))
+            LIMIT ?
+        ''', (_COST_PER_WATT_HOUR, _COST_PER_WATT_HOUR, _bucket_start(cutoff, size), max_points, max_points, max_points))
         
-        rows = c.fetchall()
-        
-        # Limit to max_points and sample evenly
-        if len(rows) > max_points:
-            step = len(rows) // max_points
-            rows = rows[::step][:max_points]
-        
-        for row in rows:
+        for row in c:
             # Create aggregated data structure
             aggregated_data = {
                 'WATTS': round(row[1], 1) if row[1] else 0,
                 'AMPS': round(row[2], 2) if row[2] else 0,
                 'LOADPCT': round(row[3], 1) if row[3] else 0,
                 'BCHARGE': round(row[4], 1) if row[4] else 0,
+                'COST_HOUR': row[8] or 0,
+                'COST_DAILY': row[9] or 0,
                 'SAMPLE_COUNT': row[5]
             }
             
             readings.append({
-                'timestamp': row[6],  # Use first timestamp of the bucket
+                'timestamp': _iso(row[6]),  # Use first timestamp of the bucket
                 'data': aggregated_data
             })
     else:
-        # For shorter periods, get all data but limit points
-        c.execute(
-            'SELECT timestamp, data FROM ups_readings WHERE timestamp > ? ORDER BY timestamp',
-            (cutoff,)
-        )
-        
-        rows = c.fetchall()
-        
-        # Limit to max_points and sample evenly
-        if len(rows) > max_points:
-            step = len(rows) // max_points
-            rows = rows[::step][:max_points]
+        # For shorter periods, get all data but limit points: number the
+        # readings from the timestamp index and fetch only every Nth row
+        c.execute('''
+            WITH numbered AS (
+                SELECT
+                    id,
+                    ROW_NUMBER() OVER (ORDER BY timestamp) - 1 as rn,
+                    COUNT(*) OVER () as total
+                FROM ups_readings
+                WHERE timestamp > ?
+            )
+            SELECT u.timestamp, u.watts, u.amps, u.loadpct, u.bcharge, u.numxfers, u.status, u.data
+            FROM numbered n
+            JOIN ups_readings u ON u.id = n.id
+            WHERE n.total <= ? OR n.rn % (n.total / ?) = 0
+            ORDER BY u.timestamp
+            LIMIT ?
+        ''', (cutoff, max_points, max_points, max_points))
         
         readings = [
             {
-                'timestamp': row[0],
-                'data': json.loads(row[1])
+                'timestamp': _iso(row[0]),
+                'data': _reading_data(row[1:])
             }
-            for row in rows
+            for row in c
         ]
     
     # Fill in zeros before the first reading if there's a gap
@@ -170,7 +656,9 @@ def get_readings(hours=24, max_points=200):
         if first_reading_time > start_time:
             # Add zero readings from start_time to first_reading_time
             if hours > 168:  # Hourly aggregation
-                # Start from the hour before the first reading and go backward
+                # Start from the hour before the first reading and go backward,
+                # collecting the fill separately so it is prepended in one step
+                fill = []
                 current_time = first_reading_time.replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
                 while current_time >= start_time:
                     zero_reading = {
@@ -180,11 +668,15 @@ def get_readings(hours=24, max_points=200):
                             'AMPS': 0,
                             'LOADPCT': 0,
                             'BCHARGE': 0,
+                            'COST_HOUR': 0,
+                            'COST_DAILY': 0,
                             'SAMPLE_COUNT': 0
                         }
                     }
-                    readings.insert(0, zero_reading)
+                    fill.append(zero_reading)
                     current_time -= timedelta(hours=1)
+                fill.reverse()
+                readings = fill + readings
             else:  # Raw data - only add zero if there's a significant gap
                 time_diff = first_reading_time - start_time
                 if time_diff.total_seconds() > 300:  # Only if gap is more than 5 minutes
@@ -199,157 +691,122 @@ def get_readings(hours=24, max_points=200):
                     }
                     readings.insert(0, zero_reading)
     
-    conn.close()
     return readings
 
-def cleanup_old_readings(days=7):
-    """Remove readings older than N days."""
-    conn = sqlite3.connect('ups_history.db')
-    c = conn.cursor()
+def cleanup_old_readings(days=7, conn=None):
+    """Remove readings older than N days and rollups past their retention."""
+    conn = conn or get_connection()
     
-    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    cutoff = int(time.time()) - days * 86400
     
-    c.execute('DELETE FROM ups_readings WHERE timestamp < ?', (cutoff,))
+    rollup_cutoff = int(time.time()) - max(days, ROLLUP_RETENTION_DAYS) * 86400
     
-    conn.commit()
-    conn.close()
+    with _transaction(conn):
+        conn.execute('DELETE FROM ups_readings WHERE timestamp < ?', (cutoff,))
+        conn.execute('DELETE FROM power_events WHERE timestamp < ?', (cutoff,))
+        conn.execute('DELETE FROM ups_readings_15m WHERE bucket < ?', (_bucket_start(cutoff, 900),))
+        conn.execute('DELETE FROM ups_readings_hourly WHERE bucket < ?', (_bucket_start(rollup_cutoff, 3600),))
+        conn.execute('DELETE FROM stats_daily WHERE day < ?', (_local_day(rollup_cutoff),))
+
+    # Fold the deletes back into the database file so the WAL does not stay
+    # at its high-water mark, and refresh planner statistics if they drifted
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('PRAGMA optimize')
 
 def get_power_events(days=7):
     """Get power events (transfers to battery) from the last N days."""
-    conn = sqlite3.connect('ups_history.db')
+    conn = get_read_connection()
     c = conn.cursor()
     
-    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    cutoff = int(time.time()) - days * 86400
     
-    # Get readings where NUMXFERS changed or STATUS contains "ONBATT"
-    # Exclude acknowledged events
-    c.execute('''
-        WITH numbered_rows AS (
-            SELECT 
-                timestamp,
-                data,
-                LAG(json_extract(data, '$.NUMXFERS')) OVER (ORDER BY timestamp) as prev_transfers,
-                json_extract(data, '$.NUMXFERS') as curr_transfers,
-                json_extract(data, '$.STATUS') as status
-            FROM ups_readings 
-            WHERE timestamp > ?
-        )
-        SELECT r.timestamp, r.data
-        FROM numbered_rows r
-        LEFT JOIN acknowledged_events a ON r.timestamp = a.event_timestamp
-        WHERE a.event_timestamp IS NULL
-        AND (
-            (r.curr_transfers != r.prev_transfers AND r.prev_transfers IS NOT NULL)
-            OR r.status LIKE '%ONBATT%'
+    # Get the recorded events, excluding acknowledged ones
+    c.execute(f'''
+        SELECT timestamp, {_READING_COLUMNS}
+        FROM power_events e
+        WHERE timestamp > ?
+        AND NOT EXISTS (
+            SELECT 1 FROM acknowledged_events a WHERE a.event_timestamp = e.timestamp
         )
-        ORDER BY r.timestamp
+        ORDER BY timestamp
     ''', (cutoff,))
     
     events = [
         {
-            'timestamp': row[0],
-            'data': json.loads(row[1])
+            'timestamp': _iso(row[0]),
+            'data': _reading_data(row[1:])
         }
-        for row in c.fetchall()
+        for row in c
     ]
     
-    conn.close()
     return events
 
 def get_power_statistics(days=7):
     """Get power usage statistics from historical data."""
-    conn = sqlite3.connect('ups_history.db')
+    conn = get_read_connection()
     c = conn.cursor()
     
-    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    # Whole days after the cutoff day, plus today so far
+    cutoff_day = _local_day(int(time.time()) - days * 86400)
     
-    # Get average, min, max watts and total readings
+    # Get average, min, max watts, total readings and the costs at the
+    # average draw from the daily totals
     c.execute('''
-        WITH parsed_data AS (
+        SELECT
+            total_readings,
+            avg_watts,
+            min_watts,
+            max_watts,
+            avg_load,
+            ROUND(avg_watts * ?, 3) as cost_per_hour,
+            ROUND(avg_watts * ? * 24, 2) as cost_per_day,
+            ROUND(avg_watts * ? * 24 * 30.44, 2) as cost_per_month,  -- Average days per month
+            ROUND(avg_watts * ? * 24 * 365.25, 2) as cost_per_year  -- Account for leap years
+        FROM (
             SELECT 
-                timestamp,
-                CAST(json_extract(data, '$.WATTS') AS FLOAT) as watts,
-                CAST(json_extract(data, '$.LOADPCT') AS FLOAT) as load_pct
-            FROM ups_readings 
-            WHERE timestamp > ?
-            AND json_extract(data, '$.WATTS') IS NOT NULL
-            AND CAST(json_extract(data, '$.WATTS') AS FLOAT) > 0
+                IFNULL(SUM(samples), 0) as total_readings,
+                IFNULL(ROUND(SUM(sum_watts) / SUM(samples), 2), 0) as avg_watts,
+                IFNULL(ROUND(MIN(min_watts), 2), 0) as min_watts,
+                IFNULL(ROUND(MAX(max_watts), 2), 0) as max_watts,
+                IFNULL(ROUND(SUM(sum_load) / SUM(samples), 2), 0) as avg_load
+            FROM stats_daily
+            WHERE day > ?
         )
-        SELECT 
-            COUNT(*) as total_readings,
-            AVG(watts) as avg_watts,
-            MIN(watts) as min_watts,
-            MAX(watts) as max_watts,
-            AVG(load_pct) as avg_load
-        FROM parsed_data
-    ''', (cutoff,))
+    ''', (_COST_PER_WATT_HOUR, _COST_PER_WATT_HOUR, _COST_PER_WATT_HOUR, _COST_PER_WATT_HOUR, cutoff_day))
     
-    result = c.fetchone()
+    row = c.fetchone()
     
-    if result:
-        stats = {
-            'total_readings': result[0],
-            'avg_watts': round(result[1], 2) if result[1] else 0,
-            'min_watts': round(result[2], 2) if result[2] else 0,
-            'max_watts': round(result[3], 2) if result[3] else 0,
-            'avg_load': round(result[4], 2) if result[4] else 0,
-            'days_analyzed': days
-        }
-        
-        # Calculate costs based on average watts
-        avg_kwh_per_hour = stats['avg_watts'] / 1000
-        avg_kwh_per_day = avg_kwh_per_hour * 24
-        avg_kwh_per_month = avg_kwh_per_day * 30.44  # Average days per month
-        avg_kwh_per_year = avg_kwh_per_day * 365.25  # Account for leap years
-        
-        # Get electricity rate from environment
-        electricity_rate = float(os.getenv('ELECTRICITY_RATE', 0.124))
-        
-        stats.update({
-            'cost_per_hour': round(avg_kwh_per_hour * electricity_rate, 3),
-            'cost_per_day': round(avg_kwh_per_day * electricity_rate, 2),
-            'cost_per_month': round(avg_kwh_per_month * electricity_rate, 2),
-            'cost_per_year': round(avg_kwh_per_year * electricity_rate, 2),
-            'electricity_rate': electricity_rate
-        })
-    else:
-        stats = {
-            'total_readings': 0,
-            'avg_watts': 0,
-            'min_watts': 0,
-            'max_watts': 0,
-            'avg_load': 0,
-            'days_analyzed': days,
-            'cost_per_hour': 0,
-            'cost_per_day': 0,
-            'cost_per_month': 0,
-            'cost_per_year': 0,
-            'electricity_rate': float(os.getenv('ELECTRICITY_RATE', 0.124))
-        }
-    
-    conn.close()
-    return stats
+    return {
+        'total_readings': row[0],
+        'avg_watts': row[1],
+        'min_watts': row[2],
+        'max_watts': row[3],
+        'avg_load': row[4],
+        'days_analyzed': days,
+        'cost_per_hour': row[5],
+        'cost_per_day': row[6],
+        'cost_per_month': row[7],
+        'cost_per_year': row[8],
+        'electricity_rate': ELECTRICITY_RATE
+    }
 
 def clear_power_events():
     """Mark all current power events as acknowledged."""
-    conn = sqlite3.connect('ups_history.db')
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        # Get all unacknowledged events
-        events = get_power_events(days=7)  # Get recent events
-        now = datetime.now().isoformat()
+        now = int(time.time())
+        cutoff = now - 7 * 86400  # Recent events
         
-        # Mark them as acknowledged
-        c.executemany(
-            'INSERT OR IGNORE INTO acknowledged_events (event_timestamp, acknowledged_at) VALUES (?, ?)',
-            [(event['timestamp'], now) for event in events]
-        )
+        # Mark the recent events as acknowledged in one statement
+        with _transaction(conn):
+            c.execute('''
+                INSERT OR IGNORE INTO acknowledged_events (event_timestamp, acknowledged_at)
+                SELECT timestamp, ? FROM power_events WHERE timestamp > ?
+            ''', (now, cutoff))
         
-        conn.commit()
         return True
     except Exception as e:
         print(f"Error acknowledging power events: {e}")
         return False
-    finally:
-        conn.close() 
\ No newline at end of file
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+app = None
+_workdir = None
+
+
+def setUpModule():
+    # Importing app initializes ups_history.db in the working directory
+    global app, _workdir
+    _workdir = tempfile.TemporaryDirectory()
+    os.chdir(_workdir.name)
+    import app as app_module
+    app = app_module
+
+
+def tearDownModule():
+    _workdir.cleanup()
+
+
+# Large enough to clear Flask-Compress's minimum size, like a real status
+STATUS = {f'FIELD{i:02d}': 'x' * 20 for i in range(40)}
+
+
+class StatusRevalidationTest(unittest.TestCase):
+    def setUp(self):
+        app._status_cache.update(ts=0.0, val=(None, None))
+        patcher = mock.patch.object(app, 'fetch_ups_status', return_value=STATUS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def test_gzip_client_gets_304(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        first = self.client.get('/api/status', headers=headers)
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers['ETag']
+
+        second = self.client.get('/api/status', headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.headers['ETag'], etag)
+
+    def test_history_still_compressed(self):
+        readings = [STATUS] * 10
+        with mock.patch.object(app.database, 'get_readings', return_value=readings):
+            response = self.client.get('/api/history', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production servers.
+Run with: gunicorn -k gthread -w 2 --threads 8 --keep-alive 15 -b 0.0.0.0:5000 wsgi:app
+"""
+
+from app import app
+
+if __name__ == "__main__":
+    app.run()